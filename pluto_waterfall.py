@@ -21,9 +21,8 @@ samples = sdr.rx() # receive samples off Pluto
 
 # Create Waterfall matrix
 num_slices = int(np.floor(num_samps/fft_size))
-waterfall = np.zeros((num_slices, fft_size))
-for i in range(num_slices):
-    waterfall[i,:] = np.log10(np.fft.fftshift(np.abs(np.fft.fft(samples[i*fft_size:(i+1)*fft_size]))**2))
+slices = samples[0:num_slices*fft_size].reshape(num_slices, fft_size) # each row is one slice, no copy
+waterfall = np.log10(np.fft.fftshift(np.abs(np.fft.fft(slices, axis=1))**2, axes=1)) # every row in one fft call instead of a loop
 
 # Plot waterfall
 time_per_row = 1.0/sample_rate * fft_size
@@ -6,18 +6,158 @@ from __future__ import print_function
 
 import numpy as np
 import time
+import functools
 from scipy import signal
+from numpy.lib.stride_tricks import sliding_window_view
+try:
+    from numba import njit, from_dtype, intp, void # optional, gives fir_filter a compiled streaming kernel
+except ImportError:
+    njit = None
 
-# a np.convolve based filter, similar to signal.lfilter() but 6x faster even though it's still python
+# direct form FIR kernel, out[c,n] = sum of taps_reversed[k]*buf[c,start+n*step+k] for every channel (row) of buf.
+#   step is the decimation factor and start the first output kept
+if njit is not None:
+    @njit(cache=True, fastmath=True, boundscheck=False)
+    def fir_kernel(buf, taps_reversed, out, start, step):
+        for c in range(out.shape[0]):
+            for n in range(out.shape[1]):
+                i = start + n*step if step > 1 else n
+                acc = taps_reversed[0] * buf[c, i]
+                for k in range(1, len(taps_reversed)):
+                    acc += taps_reversed[k] * buf[c, i + k]
+                out[c, n] = acc
+
+# generates a kernel with the taps written in as constants (fully unrolled), faster than fir_kernel for short filters.
+#   same arguments as fir_kernel, taps_reversed is ignored
+def make_fir_kernel(taps, dtype):
+    return compile_fir_kernel(taps.tobytes(), taps.dtype, np.dtype(dtype))
+
+# filters with the same taps share a kernel, bounded so every tap set ever used doesn't stay compiled for good
+@functools.lru_cache(maxsize=32)
+def compile_fir_kernel(taps_bytes, taps_dtype, dtype):
+    taps = np.frombuffer(taps_bytes, dtype=taps_dtype)
+    terms = " + ".join("t%d*buf[c, i + %d]" % (k, k) for k in range(len(taps)))
+    source = ("def fixed_taps_kernel(buf, taps_reversed, out, start, step):\n"
+              "    for c in range(out.shape[0]):\n"
+              "        if step == 1:\n"
+              "            for i in range(out.shape[1]):\n"
+              "                out[c, i] = " + terms + "\n"
+              "        else:\n"
+              "            for n in range(out.shape[1]):\n"
+              "                i = start + n*step\n"
+              "                out[c, n] = " + terms + "\n")
+    namespace = {'t%d' % k: tap for k, tap in enumerate(taps[::-1])} # numpy scalars, numba freezes globals into constants
+    exec(source, namespace)
+    # compiled now instead of on the first batch (exec'd code can't use cache=True, hence the lru_cache)
+    signatures = [kernel_signature(taps.dtype, dtype, buf_layout) for buf_layout in ('A', 'C')]
+    return njit(signatures, fastmath=True, boundscheck=False)(namespace['fixed_taps_kernel'])
+
+# argument types the kernels get compiled for, buf_layout 'C' covers a contiguous window (e.g. a single channel)
+def kernel_signature(taps_dtype, dtype, buf_layout='A'):
+    buf_type = from_dtype(dtype)[:, ::1] if buf_layout == 'C' else from_dtype(dtype)[:, :]
+    return void(buf_type, from_dtype(taps_dtype)[::1], from_dtype(dtype)[:, ::1], intp, intp)
+
+# numpy version of fir_kernel for decimating without numba, one matmul over a sliding window view of buf
+def decimating_kernel(buf, taps_reversed, out, start, step):
+    np.matmul(sliding_window_view(buf, len(taps_reversed), axis=-1)[:, start::step, :], taps_reversed, out=out)
+
+# room for the state plus at least two batches, so the state only has to be moved back to the front every few batches
+def ring_length(num_state, batch_size):
+    return 1 << (2*(num_state + batch_size) - 1).bit_length() # next power of 2
+
+# np.convolve only does 1d, so multichannel batches go through it one channel (row) at a time
+def convolve_rows(buf, taps, mode):
+    return np.array([np.convolve(row, taps, mode=mode) for row in buf])
+
+# oaconvolve can do every channel in one call, the taps just need a channel axis to broadcast against
+def oaconvolve_rows(buf, taps, mode):
+    return signal.oaconvolve(buf, taps[np.newaxis, :], mode=mode, axes=-1)
+
+# a streaming FIR filter, similar to signal.lfilter() with zi but faster. the state and batches share one ring buffer
+# batch_size is optional, long filters on big batches switch to fft based overlap-add, otherwise it uses the numba
+#   kernels if numba is installed, else np.convolve. num_channels > 1 takes (num_channels, batch_size) batches,
+#   decimate > 1 only computes the outputs it keeps, and it runs at the samples' precision (dtype, or the first batch's)
 class fir_filter:
-    def __init__(self, taps):
-        self.taps = taps
-        self.previous_batch = np.zeros(len(self.taps) - 1, dtype=np.complex128) # holds end of previous batch, this is the "state" essentially
+    def __init__(self, taps, batch_size=None, num_channels=1, dtype=None, decimate=1):
+        self.taps = np.asarray(taps)
+        self.batch_size = batch_size or 1024
+        self.num_channels = num_channels
+        self.dec = decimate
+        self.phase = 0 # index (in the next batch) of the next output that survives decimation
+        self.state_shape = (len(self.taps) - 1,) if num_channels == 1 else (num_channels, len(self.taps) - 1)
+        if batch_size is not None and len(taps) >= 64 and len(taps) * batch_size // decimate >= 2**19:
+            self.convolve = signal.oaconvolve if num_channels == 1 else oaconvolve_rows # fft computes every output regardless
+        elif njit is not None or decimate > 1:
+            self.convolve = None # use a kernel, numba's or decimating_kernel
+        else:
+            self.convolve = np.convolve if num_channels == 1 else convolve_rows # direct method, fastest for short filters and small batches
+        self.buf = None # allocated by set_dtype()
+        self.head = 0 # where the state starts in buf, the batch goes right after it
+        if dtype is not None:
+            self.set_dtype(dtype)
+
+    def set_dtype(self, dtype):
+        dtype = np.result_type(dtype, np.float32) # integer samples get filtered as float32
+        if np.iscomplexobj(self.taps):
+            dtype = np.result_type(dtype, np.complex64)
+        self.dtype = dtype
+        self.taps = self.taps.astype(dtype if np.iscomplexobj(self.taps) else np.finfo(dtype).dtype) # real taps stay real
+        self.buf = np.zeros((self.num_channels, ring_length(len(self.taps) - 1, self.batch_size)), dtype=dtype)
+        if self.convolve is None:
+            self.taps_reversed = np.ascontiguousarray(self.taps[::-1])
+            if njit is None or not np.all(np.isfinite(self.taps)): # fastmath assumes no nan/inf, it would give garbage
+                self.kernel = decimating_kernel
+            else:
+                if len(self.taps) <= 12:
+                    self.kernel = make_fir_kernel(self.taps, dtype)
+                else:
+                    self.kernel = fir_kernel
+                    for buf_layout in ('A', 'C'): # up front (or from numba's cache), not on the first batch
+                        fir_kernel.compile(kernel_signature(self.taps.dtype, dtype, buf_layout))
+            # the generated kernels vectorize across outputs, so for short filters computing every output then slicing is faster
+            self.step = 1 if njit is not None and len(self.taps) <= 8 else self.dec
+
+    @property
+    def previous_batch(self): # holds end of previous batch, this is the "state" essentially
+        if self.buf is None:
+            return np.zeros(self.state_shape)
+        return self.buf[:, self.head:self.head + len(self.taps) - 1].reshape(self.state_shape)
 
     def filter(self, x):
-        out = np.convolve(np.concatenate((self.previous_batch, x)), self.taps, mode='valid')
-        self.previous_batch = x[-(len(self.taps) - 1):] # the last portion of the batch gets saved for the next iteration #FIXME if batches become smaller than taps this won't work
-        return out
+        if self.buf is None:
+            self.set_dtype(x.dtype)
+        assert np.can_cast(x.dtype, self.dtype), "fir_filter was set up for %s samples, got %s" % (self.dtype, x.dtype)
+        assert x.ndim == 1 if self.num_channels == 1 else (x.ndim == 2 and x.shape[0] == self.num_channels), \
+            "fir_filter was set up for %d channel(s), got a batch of shape %s" % (self.num_channels, x.shape)
+        num_state = len(self.taps) - 1
+        batch_size = x.shape[-1]
+        if self.head + num_state + batch_size > self.buf.shape[1]:
+            if num_state + batch_size > self.buf.shape[1]: # batch is bigger than the ring, grow it
+                buf = np.zeros((self.num_channels, ring_length(num_state, batch_size)), dtype=self.buf.dtype)
+            else:
+                buf = self.buf
+            buf[:, 0:num_state] = self.buf[:, self.head:self.head + num_state] # wrap around, the state goes back to the front
+            self.buf = buf
+            self.head = 0
+        self.buf[:, self.head + num_state:self.head + num_state + batch_size] = x
+        window = self.buf[:, self.head:self.head + num_state + batch_size] # no copy, state followed by the new batch
+        self.head += batch_size # the last portion gets saved for the next iteration, like lfilter's zf it works for any batch size
+        start = self.phase
+        self.phase = -(batch_size - start) % self.dec
+        if self.convolve is None:
+            if self.step > 1:
+                out = np.empty((self.num_channels, max(0, -(-(batch_size - start) // self.step))), dtype=self.buf.dtype)
+                self.kernel(window, self.taps_reversed, out, start, self.step)
+            else:
+                out = np.empty((self.num_channels, batch_size), dtype=self.buf.dtype)
+                self.kernel(window, self.taps_reversed, out, 0, 1)
+                if self.dec > 1:
+                    out = out[:, start::self.dec]
+            return out if self.num_channels > 1 else out[0]
+        out = self.convolve(window if self.num_channels > 1 else window[0], self.taps, mode='valid')
+        if self.dec > 1:
+            out = out[..., start::self.dec]
+        return out.astype(self.dtype, copy=False)
 
 # an fft based filter (currently sux)
 class fft_filter:
@@ -25,8 +165,9 @@ class fft_filter:
         self.taps = taps
         self.previous_batch = np.zeros(len(self.taps) - 1, dtype=np.complex128) # holds end of previous batch, this is the "state" essentially
     def filter(self, x):
-        out = signal.fftconvolve(np.concatenate((self.previous_batch, x)), self.taps, mode='valid')
-        self.previous_batch = x[-(len(self.taps) - 1):] # the last portion of the batch gets saved for the next iteration #FIXME if batches become smaller than taps this won't work
+        buf = np.concatenate((self.previous_batch, x))
+        out = signal.fftconvolve(buf, self.taps, mode='valid')
+        self.previous_batch = buf[len(x):] # the last portion gets saved for the next iteration, works for any batch size
         return out
 
 
@@ -48,7 +189,7 @@ if __name__ == '__main__': # (call this script directly to run tests)
     test_filter = fir_filter(taps) # initialize filters
     test_filter2 = fft_filter(taps)
     zi = np.zeros(len(taps) - 1) # used for lfilter
-    for i in range(len(x)/batch_size):
+    for i in range(len(x)//batch_size):
         x_input = x[i*batch_size:(i+1)*batch_size] # this line represents the incoming stream
         filter_output = test_filter.filter(x_input) # run the filter
         y2 = np.concatenate((y2, filter_output)) # add output to our log
@@ -65,5 +206,59 @@ if __name__ == '__main__': # (call this script directly to run tests)
     print("fir_filter test passed?", np.allclose(y, y2, rtol=1e-10))
     print("fft_filter test passed?", np.allclose(y, y3, rtol=1e-10)) 
     print("lfilter test passed?",    np.allclose(y, y4, rtol=1e-10))
-    
 
+    # long filter with big batches, where fir_filter switches over to overlap-add
+    x = np.random.randn(20000) + 1j*np.random.randn(20000)
+    taps = np.random.rand(200)
+    y = np.convolve(x, taps, mode='valid')
+    batch_size = 4000
+    test_filter = fir_filter(taps, batch_size)
+    y2 = np.zeros(0)
+    for i in range(len(x)//batch_size):
+        y2 = np.concatenate((y2, test_filter.filter(x[i*batch_size:(i+1)*batch_size])))
+    y2 = y2[len(taps)-1:]
+    print("fir_filter (overlap-add) test passed?", test_filter.convolve is signal.oaconvolve and np.allclose(y, y2, rtol=1e-10))
+
+    # multiple channels filtered together, each one should match filtering it on its own
+    num_channels = 3
+    x = np.random.randn(num_channels, 1000) + 1j*np.random.randn(num_channels, 1000)
+    taps = np.random.rand(30)
+    y = np.array([np.convolve(row, taps, mode='valid') for row in x])
+    batch_size = 100
+    test_filter = fir_filter(taps, num_channels=num_channels)
+    y2 = np.zeros((num_channels, 0))
+    for i in range(x.shape[1]//batch_size):
+        y2 = np.concatenate((y2, test_filter.filter(x[:, i*batch_size:(i+1)*batch_size])), axis=1)
+    y2 = y2[:, len(taps)-1:]
+    print("fir_filter (multichannel) test passed?", np.allclose(y, y2, rtol=1e-10))
+
+    # short filter, where (with numba) fir_filter generates a kernel with the taps written into it
+    x = np.random.randn(1000) + 1j*np.random.randn(1000)
+    taps = np.random.rand(7)
+    y = np.convolve(x, taps, mode='valid')
+    batch_size = 100
+    test_filter = fir_filter(taps, batch_size)
+    y2 = np.zeros(0)
+    for i in range(len(x)//batch_size):
+        y2 = np.concatenate((y2, test_filter.filter(x[i*batch_size:(i+1)*batch_size])))
+    y2 = y2[len(taps)-1:]
+    print("fir_filter (short filter) test passed?", np.allclose(y, y2, rtol=1e-10))
+
+    # complex64 samples should come out as complex64, not get upcast by the float64 taps
+    x = (np.random.randn(1000) + 1j*np.random.randn(1000)).astype(np.complex64)
+    taps = np.random.rand(30)
+    y = np.convolve(x.astype(np.complex128), taps, mode='valid')
+    test_filter = fir_filter(taps)
+    y2 = np.concatenate([test_filter.filter(x[i*batch_size:(i+1)*batch_size]) for i in range(len(x)//batch_size)])
+    y2 = y2[len(taps)-1:]
+    print("fir_filter (complex64) test passed?", y2.dtype == np.complex64 and np.allclose(y, y2, rtol=1e-4, atol=1e-4))
+
+    # decimating, should match filtering everything then keeping every decimate'th output (batches aren't a multiple of it)
+    x = np.random.randn(1000) + 1j*np.random.randn(1000)
+    decimation_factor = 7
+    for num_taps in (30, 7): # generic and (with numba) generated kernel
+        taps = np.random.rand(num_taps)
+        y = np.convolve(x, taps, mode='full')[0:len(x):decimation_factor] # full keeps the start up transient, like the stream does
+        test_filter = fir_filter(taps, decimate=decimation_factor)
+        y2 = np.concatenate([test_filter.filter(x[i*batch_size:(i+1)*batch_size]) for i in range(len(x)//batch_size)])
+        print("fir_filter (decimating, %d taps) test passed?" % num_taps, np.allclose(y, y2, rtol=1e-10))
@@ -12,10 +12,19 @@ import time
 import threading
 import logging
 import numpy as np
+import scipy.fft
 import uhd
 from PyQt5.QtWidgets import QApplication, QWidget, QGridLayout, QPushButton
-from PyQt5.QtCore import QRect
+from PyQt5.QtCore import QRect, QTimer
 import pyqtgraph as pg
+try:
+    import pyfftw # optional, plans the display ffts once at startup instead of np.fft redoing it every call
+except ImportError:
+    pyfftw = None
+try:
+    import cupy, cupyx # optional, only used when use_gpu is set
+except ImportError:
+    cupy = None
 
 
 # Parameters
@@ -27,6 +36,10 @@ fft_size = 512
 num_rows = 100
 num_to_avg = 50
 chunk_decimation_factor = 10 # so that we dont processes 100% of samples
+ring_size = 64 # packets the rx thread can get ahead of the display by, has to be a power of 2
+display_rate = 30 # Hz
+waterfall_range = 40 # dB shown by the waterfall colors, starting just below the noise floor of the first packet
+use_gpu = False # do the display ffts on a CUDA gpu using CuPy/cuFFT, if CuPy is installed
 
 CLOCK_TIMEOUT = 1000  # 1000mS timeout for external clock locking
 INIT_DELAY = 0.05  # 50mS initial delay before transmit
@@ -35,16 +48,46 @@ INIT_DELAY = 0.05  # 50mS initial delay before transmit
 
 
 
-def benchmark_rx_rate(usrp, rx_streamer, timer_elapsed_event, rx_statistics, win):
+# np.empty only guarantees 16 byte alignment, this starts the data on a 64 byte boundary (a cache line, and the widest
+#   SIMD registers) so uhd's copy of each packet into it, and the ring copies after, run on aligned full width stores
+def empty_aligned(shape, dtype, align=64):
+    if pyfftw is not None:
+        return pyfftw.empty_aligned(shape, dtype=dtype, n=align)
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + align, dtype=np.uint8)
+    offset = -raw.ctypes.data % align
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+# the packets we want displayed get copied into this ring by the rx thread (the only writer), and the GUI thread (the only
+#   reader) processes them on its own time, see Example.update_display. it holds no Qt objects, so the rx thread never
+#   touches the window. write_idx only ever goes up and the slot is write_idx & (ring_size-1)
+class PacketRing:
+    def __init__(self, packet_size):
+        if use_gpu and cupy is not None:
+            self.slots = cupyx.empty_pinned((ring_size, packet_size), dtype=np.complex64) # pinned so the copy to the gpu can be async
+        else:
+            self.slots = empty_aligned((ring_size, packet_size), np.complex64)
+        self.write_idx = 0 # only published once a packet is fully copied in. a single int store, so it's atomic under the GIL
+
+
+def benchmark_rx_rate(usrp, rx_streamer, timer_elapsed_event, rx_statistics, ring):
     """Benchmark the receive chain"""
     logger.info("Testing receive rate {:.3f} Msps on {:d} channels".format(usrp.get_rx_rate()/1e6, 1))
 
     # Make a receive buffer
     max_samps_per_packet = rx_streamer.get_max_num_samps()
     # TODO: The C++ code uses rx_cpu type here. Do we want to use that to set dtype?
-    recv_buffer = np.empty((1, max_samps_per_packet), dtype=np.complex64)
+    # recv always copies out of uhd's own frame buffers, there's no acquire/release api to get at them from python, so the
+    #   best we can do is make that copy cheap
+    recv_buffer = empty_aligned((1, max_samps_per_packet), np.complex64)
     metadata = uhd.types.RXMetadata()
 
+    # packets only get copied into the ring, so this thread never waits on ffts or plotting
+    slots = ring.slots
+    ring_mask = ring_size - 1
+
     # Craft and send the Stream Command
     stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
     stream_cmd.stream_now = True
@@ -65,67 +108,39 @@ def benchmark_rx_rate(usrp, rx_streamer, timer_elapsed_event, rx_statistics, win
     num_rx_late = 0
 
     rate = usrp.get_rx_rate()
+    # this loop runs once per packet (thousands of times a second), so everything it touches on every pass gets looked up
+    #   once here instead of going through module and object attributes each time
+    recv = rx_streamer.recv
+    stop_requested = timer_elapsed_event.is_set
+    ERROR_CODE_NONE = uhd.types.RXMetadataErrorCode.none
+    packet = recv_buffer[0]
+    write_idx = 0
     # Receive until we get the signal to stop
     i = 0
-    ii = 0
-    rx_streamer.recv(recv_buffer, metadata) # to see around what level we are receiving at, to init waterfall 2d array
-    avg_value = np.mean(10.0*np.log10(np.abs(np.fft.fft(recv_buffer[0], fft_size))))
-    data = avg_value * np.ones((fft_size, num_rows))
-    running_avg = np.zeros(fft_size)
-    first_time = True
-    f = np.linspace(rx_freq - rx_rate/2.0, rx_freq + rx_rate/2.0, fft_size) / 1e6
-    t = np.arange(500)/rx_rate*1e6
-    while not timer_elapsed_event.is_set():
+    while not stop_requested():
         try:
-            rx_streamer.recv(recv_buffer, metadata)
-            i += 1
-            if i == chunk_decimation_factor: # used to chunck decimate, so that we dont have to process 100% of samples...
-                running_avg += np.abs(np.fft.fft(recv_buffer[0], fft_size))
-                i = 0
-                ii += 1
-                if ii == num_to_avg:
-                    win.time_plot_curve_i.setData(t, np.real(recv_buffer[0][0:500])) # time plot
-                    win.time_plot_curve_q.setData(t, np.imag(recv_buffer[0][0:500])) # time plot
-                    
-                    fft = 10.0*np.log10(np.fft.fftshift(running_avg/num_to_avg))
-                    
-                    win.fft_plot_curve_fft.setData(f, fft) # FFT plot
-                
-                    # create waterfall
-                    data[:] = np.roll(data, 1, axis=1) # shifts waterfall 1 row
-                    data[:,0] = fft # fill last row with new fft results
-                        
-                    # Display waterfall
-                    win.imageitem.setImage(data) # auto ranges by default
-                    
-                    running_avg = np.zeros(fft_size)
-                    ii = 0
-                    
-                    if first_time:
-                        first_time = False
-                        # time and freq adjustments
-                        win.time_plot.autoRange()
-                        win.fft_plot.autoRange()
-                        # waterfall adjustments
-                        samples_per_row = len(recv_buffer[0]) * num_to_avg * chunk_decimation_factor / rx_rate
-                        win.imageitem.translate((rx_freq - rx_rate/2.0)/1e6, 0)
-                        win.imageitem.scale(rx_rate/fft_size/1e6, samples_per_row)
-                        win.waterfall.autoRange()
-        
-                
+            recv(recv_buffer, metadata)
         except RuntimeError as ex:
             logger.error("Runtime error in receive: %s", ex)
             return
+        i += 1
+        if i == chunk_decimation_factor: # used to chunck decimate, so that we dont have to process 100% of samples...
+            slots[write_idx & ring_mask] = packet
+            write_idx += 1
+            ring.write_idx = write_idx
+            i = 0
 
         # Handle the error codes
-        if metadata.error_code == uhd.types.RXMetadataErrorCode.none:
+        error_code = metadata.error_code
+        if error_code == ERROR_CODE_NONE: # the normal case, so it gets checked first and on its own
+            if not had_an_overflow:
+                continue
             # Reset the overflow flag
-            if had_an_overflow:
-                had_an_overflow = False
-                num_rx_dropped += uhd.types.TimeSpec(
-                    metadata.time_spec.get_real_secs() - last_overflow.get_real_secs()
-                ).to_ticks(rate)
-        elif metadata.error_code == uhd.types.RXMetadataErrorCode.overflow:
+            had_an_overflow = False
+            num_rx_dropped += uhd.types.TimeSpec(
+                metadata.time_spec.get_real_secs() - last_overflow.get_real_secs()
+            ).to_ticks(rate)
+        elif error_code == uhd.types.RXMetadataErrorCode.overflow:
             had_an_overflow = True
             last_overflow = metadata.time_spec
             # If we had a sequence error, record it
@@ -135,7 +150,7 @@ def benchmark_rx_rate(usrp, rx_streamer, timer_elapsed_event, rx_statistics, win
             # Otherwise just count the overrun
             else:
                 num_rx_overruns += 1
-        elif metadata.error_code == uhd.types.RXMetadataErrorCode.late:
+        elif error_code == uhd.types.RXMetadataErrorCode.late:
             logger.warning("Receiver error: %s, restarting streaming...", metadata.strerror())
             num_rx_late += 1
             # Radio core will be in the idle state. Issue stream command to restart streaming.
@@ -143,7 +158,7 @@ def benchmark_rx_rate(usrp, rx_streamer, timer_elapsed_event, rx_statistics, win
                 usrp.get_time_now().get_real_secs() + INIT_DELAY)
             stream_cmd.stream_now = True
             rx_streamer.issue_stream_cmd(stream_cmd)
-        elif metadata.error_code == uhd.types.RXMetadataErrorCode.timeout:
+        elif error_code == uhd.types.RXMetadataErrorCode.timeout:
             logger.warning("Receiver error: %s, continuing...", metadata.strerror())
             num_rx_timeouts += 1
         else:
@@ -194,6 +209,16 @@ class Example(QWidget):
         self.waterfall.addItem(self.imageitem)
         self.waterfall.setMouseEnabled(x=False, y=False)
         grid.addWidget(self.waterfall, 3, 0)
+        
+        # display buffers, allocated once here instead of on every display update
+        self.time_x = np.arange(500)/rx_rate*1e6
+        self.time_iq = np.empty((2, 500), dtype=np.float32) # I and Q split into their own contiguous rows
+        self.fft_x = np.linspace(rx_freq - rx_rate/2.0, rx_freq + rx_rate/2.0, fft_size) / 1e6
+        self.fft_data = np.empty(fft_size, dtype=np.float32)
+        self.fft_scaled = np.empty(fft_size, dtype=np.float32) # fft_data mapped onto 0-255
+        # the waterfall is stored as 8 bit, the colormap only has 256 colors anyway, so this is 4x less to push through
+        #   pyqtgraph's lookup table and to the screen. each row is stored twice, see draw()
+        self.waterfall_data = np.empty((fft_size, 2*num_rows), dtype=np.uint8, order='F')
   
         self.setGeometry(300, 300, 300, 220) # window placement and size
         self.setWindowTitle('RTL-SDR Demo')
@@ -203,6 +228,148 @@ class Example(QWidget):
     def handleButton(self):
         self.time_plot.autoRange()
         self.fft_plot.autoRange()
+    
+    def start_display(self, ring):
+        self.gpu = use_gpu and cupy is not None
+        self.ring = ring # filled by the rx thread
+        # the GUI side only ever reads the slots. they're 64 byte aligned, which is exactly what lets pyfftw (or anything
+        #   else given a view of them) work on a slot in place, so a read only view makes that an error instead of a torn packet
+        self.slots = ring.slots.view()
+        self.slots.flags.writeable = False
+        self.read_idx = 0
+        
+        # each packet gets viewed as rows of fft_size samples, so a packet is one batched fft instead of a python loop of ffts.
+        #   a packet shorter than fft_size gets copied into one zero padded row instead, like np.fft.fft(x, fft_size) would
+        packet_size = ring.slots.shape[1]
+        self.num_frames = max(1, packet_size // fft_size)
+        self.padded = np.zeros((1, fft_size), dtype=np.complex64) if packet_size < fft_size else None
+        num_time = min(500, packet_size) # the time plot shows up to the first 500 samples of a packet
+        self.time_x = self.time_x[0:num_time]
+        self.time_iq = self.time_iq[:, 0:num_time]
+        if pyfftw is not None:
+            # the size never changes, so measure the best plan once and reuse it. frames get copied into the plan's own input
+            #   array first, handing them to the plan directly would let it transform (and with overwrite_input, destroy) the
+            #   ring slot in place whenever the slot's alignment and strides match, and draw() still reads the packet from there
+            plan = pyfftw.builders.fft(pyfftw.empty_aligned((self.num_frames, fft_size), dtype='complex64'), axis=1,
+                                       overwrite_input=True, planner_effort='FFTW_MEASURE', threads=2)
+            def batched_fft(x):
+                plan.input_array[:] = x
+                return plan() # runs on input_array, returns the plan's output_array
+            self.batched_fft = batched_fft
+        else:
+            # scipy's fft releases the GIL (so the rx thread can keep going) and spreads the rows over all cores.
+            # it also stays in complex64, np.fft did everything in complex128. dont use overwrite_x, frames is a view of the ring
+            self.batched_fft = lambda x: scipy.fft.fft(x, axis=1, workers=-1)
+        if self.gpu:
+            # the frames get copied over on their own stream, and the running average stays on the gpu until it's displayed
+            self.stream = cupy.cuda.Stream(non_blocking=True)
+            self.d_frames = cupy.empty((self.num_frames, fft_size), dtype=np.complex64)
+            self.d_running_avg = cupy.zeros(fft_size, dtype=np.float32)
+        self.running_avg = np.zeros(fft_size, dtype=np.float32)
+        self.spectra = np.empty((self.num_frames, fft_size), dtype=np.float32) # |fft| of the packet's rows, reused every packet
+        self.spectra_sum = np.empty(fft_size, dtype=np.float32)
+        self.num_averaged = 0
+        self.wf_idx = 0 # column of waterfall_data holding the newest row
+        self.waterfall_min = None # set from the first packet that gives a finite level
+        self.first_time = True
+        
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.update_display)
+        self.timer.start(1000 // display_rate)
+    
+    def update_display(self):
+        # runs on the GUI thread, processes whatever packets the rx thread added to the ring since last time
+        write_idx = self.ring.write_idx
+        if write_idx - self.read_idx > ring_size // 2:
+            self.read_idx = write_idx - ring_size // 2 # we fell behind, skip ahead instead of reading slots that are being refilled
+        while self.read_idx < write_idx:
+            idx = self.read_idx
+            packet = self.slots[idx & (ring_size - 1)]
+            self.read_idx += 1
+            if self.padded is None:
+                frames = packet[0:self.num_frames*fft_size].reshape(self.num_frames, fft_size)
+            else:
+                self.padded[0, 0:len(packet)] = packet
+                frames = self.padded
+            # one batched fft per packet feeds everything, the fft plot and waterfall both come from its average over rows
+            if self.gpu:
+                self.d_frames.set(frames, stream=self.stream)
+                self.stream.synchronize() # the copy out of the ring is async, it has to be done before the check below means anything
+            else:
+                # all rows of the packet in one call, into preallocated arrays. numpy's complex64 abs is SIMD, doing re*re + im*im
+                #   by hand timed slower for these few rows, and the log10 only runs on the averaged spectrum in draw()
+                spectra = np.abs(self.batched_fft(frames), out=self.spectra)
+            if self.ring.write_idx - idx >= ring_size:
+                continue # the rx thread lapped us and was refilling this slot while we read it, drop it instead of a torn packet
+            if self.gpu:
+                with self.stream:
+                    spectra = cupy.abs(cupy.fft.fft(self.d_frames, axis=1)) # batched cuFFT, plan is cached by cupy
+                    self.d_running_avg += spectra.sum(axis=0)
+            else:
+                self.running_avg += np.add.reduce(spectra, axis=0, out=self.spectra_sum)
+            if self.waterfall_min is None:
+                # see around what level we are receiving at, to set the waterfall's range and init waterfall 2d array.
+                #   reuses the spectra above, this used to run the packet through a second fft just for this. the levels
+                #   stay fixed after this, so a packet with a zero bin (-inf) or garbage in it (nan) doesn't get to set them
+                if self.gpu:
+                    self.stream.synchronize() # spectra is queued on self.stream, the log10 below runs on the null stream
+                level = float((10.0*np.log10(spectra)).mean())
+                if np.isfinite(level):
+                    self.waterfall_min = level - 5.0
+                    self.waterfall_data[:] = int(5.0 * 255 / waterfall_range)
+            self.num_averaged += 1
+            if self.num_averaged == num_to_avg:
+                self.draw(packet)
+    
+    def draw(self, packet):
+        if self.gpu:
+            self.d_running_avg.get(stream=self.stream, out=self.running_avg) # only fft_size floats come back from the gpu
+            with self.stream:
+                self.d_running_avg.fill(0)
+        # split I and Q into their own planes, packet.view(float32) is [i0, q0, i1, q1...] so this is a strided
+        #   (no allocation) read. the plots get contiguous arrays, and they dont point into the ring, which the rx thread refills
+        num_time = self.time_iq.shape[1]
+        self.time_iq[:] = packet[0:num_time].view(np.float32).reshape(num_time, 2).T
+        self.time_plot_curve_i.setData(self.time_x, self.time_iq[0]) # time plot
+        self.time_plot_curve_q.setData(self.time_x, self.time_iq[1]) # time plot
+        
+        # average and fftshift in one pass, the two halves get swapped as they're written (np.fft.fftshift would make a copy)
+        fft = self.fft_data
+        k = fft_size // 2
+        np.divide(self.running_avg[fft_size - k:], num_to_avg*self.num_frames, out=fft[0:k])
+        np.divide(self.running_avg[0:fft_size - k], num_to_avg*self.num_frames, out=fft[k:])
+        np.log10(fft, out=fft)
+        fft *= 10.0
+        
+        self.fft_plot_curve_fft.setData(self.fft_x, fft) # FFT plot
+        
+        # create waterfall. waterfall_data holds every row twice, so the last num_rows rows are always one
+        # contiguous view starting at wf_idx, and adding a row never has to shift the whole image
+        if self.waterfall_min is not None: # None until a packet gives a usable level, see update_display()
+            np.subtract(fft, self.waterfall_min, out=self.fft_scaled)
+            self.fft_scaled *= 255.0 / waterfall_range
+            np.nan_to_num(self.fft_scaled, copy=False) # nan to 0 (and inf to the float max, clipped below), casting nan to uint8 is undefined
+            np.clip(self.fft_scaled, 0, 255, out=self.fft_scaled)
+            self.wf_idx = (self.wf_idx - 1) % num_rows
+            self.waterfall_data[:, self.wf_idx] = self.fft_scaled
+            self.waterfall_data[:, self.wf_idx + num_rows] = self.fft_scaled
+            
+            # Display waterfall, the levels are fixed so pyqtgraph doesn't have to search every frame for the min and max
+            self.imageitem.setImage(self.waterfall_data[:, self.wf_idx:self.wf_idx + num_rows], autoLevels=False, levels=(0, 255))
+        
+        self.running_avg[:] = 0
+        self.num_averaged = 0
+        
+        if self.first_time:
+            self.first_time = False
+            # time and freq adjustments
+            self.time_plot.autoRange()
+            self.fft_plot.autoRange()
+            # waterfall adjustments
+            samples_per_row = len(packet) * num_to_avg * chunk_decimation_factor / rx_rate
+            self.imageitem.translate((rx_freq - rx_rate/2.0)/1e6, 0)
+            self.imageitem.scale(rx_rate/fft_size/1e6, samples_per_row)
+            self.waterfall.autoRange()
                     
             
 if __name__ == "__main__":
@@ -242,7 +409,9 @@ if __name__ == "__main__":
     st_args.channels = rx_channels
     rx_streamer = usrp.get_rx_stream(st_args)
     print("max samps per buffer: ", rx_streamer.get_max_num_samps()) # affected by recv_frame_size
-    rx_thread = threading.Thread(target=benchmark_rx_rate, args=(usrp, rx_streamer, quit_event, rx_statistics, ex))
+    ring = PacketRing(rx_streamer.get_max_num_samps())
+    ex.start_display(ring)
+    rx_thread = threading.Thread(target=benchmark_rx_rate, args=(usrp, rx_streamer, quit_event, rx_statistics, ring))
     threads.append(rx_thread)
     rx_thread.start()
     rx_thread.setName("bmark_rx_stream")